@@ -1,82 +1,88 @@
 from greenbox import GreenBox
 from secrets import *
-import paho.mqtt.client as mqtt
+import aiomqtt
 import asyncio
-import threading
+import json
+import sys
 
 class Communicator:
-    def __init__(self, broker, command_topic, data_topics):
+    """ Async MQTT link to the broker. Use as an async context manager;
+        the socket is driven directly by the running event loop. """
+    def __init__(self, broker, port, command_topic, state_topic):
         self.broker = broker
+        self.port = port
         self.command_topic = command_topic
-        self.data_topics = data_topics
-        self.command_queue = asyncio.Queue()
-        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id='Greenbox')
-        # Connect to the MQTT broker
-        self._setup_callbacks()
-        self.client.connect(MQTT_BROKER, MQTT_PORT, 6000)
+        self.state_topic = state_topic
+        # Reusable across reconnects, but not reentrant
+        self.client = aiomqtt.Client(self.broker, port=self.port, identifier='Greenbox')
 
-    def _setup_callbacks(self):
-        def on_connect(client, userdata, flags, rc, props=None):
-            print("MQTT Connected.")
-            client.subscribe(self.command_topic)
+    async def __aenter__(self):
+        await self.client.__aenter__()
+        try:
+            await self.client.subscribe(self.command_topic)
+        except BaseException:
+            await self.client.__aexit__(*sys.exc_info())
+            raise
+        print("MQTT Connected.")
+        return self
 
-        def on_message(client, userdata, msg):
-            print(f"Received MQTT: {msg.topic} -> {msg.payload.decode()}")
-            # Push to asyncio-safe queue via event loop
-            asyncio.run_coroutine_threadsafe(
-                self.command_queue.put(msg.payload.decode()), asyncio.get_event_loop()
-            )
-        self.client.on_connect = on_connect
-        self.client.on_message = on_message
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.client.__aexit__(exc_type, exc, tb)
 
-    def start(self):
-        def run():
-            self.client.connect(self.broker)
-            self.client.loop_forever()
-        threading.Thread(target=run, daemon=True).start()
+    def __aiter__(self):
+        return self
 
-    async def receive_command(self):
-        return await self.command_queue.get()
+    async def __anext__(self):
+        """ Next command payload from the command topic. """
+        msg = await anext(self.client.messages)
+        command = msg.payload.decode()
+        print(f"Received MQTT: {msg.topic} -> {command}")
+        return command
 
-    def publish(self, payload_list):
-        for topic, payload in zip(self.data_topics, payload_list):
-            self.client.publish(topic, payload)
+    async def publish(self, payload_dict):
+        await self.client.publish(self.state_topic, json.dumps(payload_dict))
 
-async def run_communication():
+async def consume_commands(greenbox, communicator):
+    """ Toggle the light for every command received. """
+    async for command in communicator:
+        try:
+            await greenbox.toggle_light()
+        except Exception as Err:
+            # A failed write (e.g. device out of range) must not take down the MQTT loop
+            print(f"Command failed: {Err}")
+
+async def publish_loop(greenbox, communicator):
+    """ Refresh the CLI and publish device data every 10 seconds. """
+    while True:
+        data = greenbox.get_data()
+        greenbox.update()
+        await communicator.publish({k: data[k] for k in ('water_lvl', 'light_on', 'is_connected')})
+        await asyncio.sleep(10)
+
+async def run_communication(reconnect_interval=5):
     base = "home-assistant/greenbox/"
     communicator = Communicator(
         broker=MQTT_BROKER,
+        port=MQTT_PORT,
         command_topic=f"{base}command",
-        data_topics=[f"{base}water_lvl", f"{base}light_on", f"{base}is_connected"]
+        state_topic=f"{base}state"
     )
-    communicator.start()
 
+    # The BLE link stays up while the broker connection comes and goes
     async with GreenBox(DEVICE_ADDR) as greenbox:
         while True:
             try:
-                command_task = asyncio.create_task(communicator.receive_command())
-                cmd, pending = await asyncio.wait({command_task}, timeout=1)
-
-                if command_task in cmd:
-                    command = command_task.result()
-                    greenbox.toggle_light()
-                else:
-                    # Cancel unfinished task and wait for it to exit cleanly
-                    command_task.cancel()
-                    try:
-                        await command_task
-                    except asyncio.CancelledError:
-                        pass
-
-                data = greenbox.get_data()
-                greenbox.update()
-                communicator.publish([data['water_lvl'], data['light_on'], data['is_connected']])
-                await asyncio.sleep(9)
-            except asyncio.CancelledError:
-                break
+                async with communicator:
+                    async with asyncio.TaskGroup() as tg:
+                        tg.create_task(consume_commands(greenbox, communicator))
+                        tg.create_task(publish_loop(greenbox, communicator))
+            except* aiomqtt.MqttError as err:
+                print(f"MQTT connection lost: {err.exceptions[0]}. "
+                      f"Reconnecting in {reconnect_interval} seconds.")
+            await asyncio.sleep(reconnect_interval)
 
 if __name__ == "__main__":
     try:
         asyncio.run(run_communication())
     except KeyboardInterrupt:
-        print("Stopped.")
\ No newline at end of file
+        print("Stopped.")
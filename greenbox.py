@@ -1,17 +1,33 @@
 import asyncio
+from collections import OrderedDict
 from bleak import BleakClient
-import os
+import struct
+import sys
+import time
 from datetime import datetime, timezone, timedelta
 import logging
 from greenbox_message_ids import *
 
 logger = logging.getLogger(__name__)
 
+_pack_7b = struct.Struct('6B').pack
+_tx_flush_timeout = 5 # Seconds to wait for queued writes on a clean shutdown.
+_data_store_size = 256 # Most notifications kept in the debug data store.
+
 class GreenBox:
     """ GreenBox connector from python.
         Provides a context manager which allows control over a single Berlin GreenBox.
         Call with known MAC (in "XX:XX:XX:XX:XX:XX") format. Scanner comes soon.
         Tested with base model. """
+    __slots__ = ('wake_hours_utc', 'wake_minutes_utc', 'hours_on', 'wake_hours_weekend_utc',
+                 'timeout_seconds', 'wake_minutes_weekend_utc', 'hours_on_weekend', 'weekend_enabled',
+                 'light_status', 'light_on', 'lamp_lvl', 'water_lvl', 'timestamp',
+                 '_data_store', '_debug', '_device_address', '_client',
+                 '_last_now', '_last_now_mono', '_tx_queue', '_tx_task', '_write_response',
+                 '_log_queue', '_log_task', '_dispatch')
+    # Public fields reported by get_data, in slot order
+    _public_fields = tuple(k for k in __slots__ if not k.startswith('_'))
+
     def __init__(self, device_address):
         self.wake_hours_utc = 0
         self.wake_minutes_utc = 0
@@ -26,66 +42,95 @@ class GreenBox:
         self.lamp_lvl = [0,0,0]
         self.water_lvl = 0
         self.timestamp = None
-        self._data_store = {}
+        self._data_store = OrderedDict()
         self._debug = True
         self._device_address = device_address
         self._client = BleakClient(self._device_address)
+        self._last_now = None
+        self._last_now_mono = float('-inf')
         self.update_timestamp()
-        self._bt_write_lock = asyncio.Lock()
-        self._notification_queue = asyncio.Queue()
+        self._tx_queue = asyncio.Queue(maxsize=8)
+        self._write_response = False
+        self._tx_task = None
+        self._log_task = None
+        self._log_queue = asyncio.Queue()
+        self._dispatch = {gb_wake_time: self._set_wake_time,
+                          gb_wake_hours: self._set_hours_on,
+                          gb_wake_hours_wknd: self._set_hours_on_weekend,
+                          gb_wake_time_wknd: self._set_wake_time_weekend,
+                          gb_water: self._set_water_lvl,
+                          gb_light_on: self._set_light_status}
 
         return
+    def _now_utc(self):
+        """ Current UTC time, refreshed at most every half second. """
+        mono = time.monotonic()
+        if mono - self._last_now_mono > 0.5:
+            self._last_now = datetime.now(timezone.utc)
+            self._last_now_mono = mono
+        return self._last_now
+
     def update_timestamp(self):
-        self.timestamp = datetime.now(timezone.utc)
+        self.timestamp = self._now_utc()
 
     def is_connected(self):
         delta = timedelta(seconds=self.timeout_seconds)
-        now_utc = datetime.now(timezone.utc)
-        return (self.timestamp + delta) > now_utc
+        return (self.timestamp + delta) > self._now_utc()
 
     def get_data(self) -> dict:
-        value_dict= {
-            k: getattr(self, k)
-            for k, v in self.__dict__.items()
-            if not k.startswith('_')
-        }
+        value_dict = {k: getattr(self, k) for k in self._public_fields}
         value_dict['is_connected'] = self.is_connected()
         return value_dict
 
     def proc_all(self, data, timestamp):
         # Data logging. Will be removed soon
-        hex_data = data.hex()
-        if hex_data in self._data_store.keys():
-            self._data_store[hex_data]["timestamp"] = timestamp
+        key = bytes(data)
+        entry = self._data_store.get(key)
+        if entry is not None:
+            entry["timestamp"] = timestamp
+            self._data_store.move_to_end(key)
         else:
             parsed_id, parsed_val = self.parse_7b_notification(data)
-            self._data_store[hex_data] = {"timestamp": timestamp, "first_timestamp": timestamp,
+            self._data_store[key] = {"timestamp": timestamp, "first_timestamp": timestamp,
                                                    "raw_val": list(data), "val_id":parsed_id,
                                                    "parsed": [parsed_id, parsed_val]}
+            if len(self._data_store) > _data_store_size:
+                # Drop the least recently seen entry
+                self._data_store.popitem(last=False)
     def proc_known_ids(self, data):
         """ Parse currently readable data into human-readable form."""
         # I should probably move all these values into timestamped containers to see if any go out of date.
         val_id, val = self.parse_7b_notification(data)
-        if val_id == gb_wake_time:
-            self.wake_hours_utc = val // 100
-            self.wake_minutes_utc = val - self.wake_hours_utc * 100
-        if val_id == gb_wake_hours:
-            self.hours_on = val
-        if val_id == gb_wake_hours_wknd:
-            self.weekend_enabled = val > 0
-            self.hours_on_weekend = val
-        if val_id == gb_wake_time_wknd:
-            self.wake_hours_weekend_utc  = val // 100
-            self.wake_minutes_weekend_utc = val - self.wake_hours_weekend_utc * 100
-        if val_id == gb_water:
-            self.water_lvl = val
-        if val_id in gb_lamps:
-            self.lamp_lvl[gb_lamps.index(val_id)] = val
-        if val_id == gb_light_on:
-            self.light_status = val
-            self.check_light_status()
+        handler = self._dispatch.get(val_id)
+        if handler is not None:
+            handler(val)
+        lamp = gb_lamp_index.get(val_id)
+        if lamp is not None:
+            self.lamp_lvl[lamp] = val
         self.update_timestamp()
 
+    def _set_wake_time(self, val):
+        self.wake_hours_utc = val // 100
+        self.wake_minutes_utc = val - self.wake_hours_utc * 100
+
+    def _set_hours_on(self, val):
+        self.hours_on = val
+
+    def _set_hours_on_weekend(self, val):
+        self.weekend_enabled = val > 0
+        self.hours_on_weekend = val
+
+    def _set_wake_time_weekend(self, val):
+        self.wake_hours_weekend_utc = val // 100
+        self.wake_minutes_weekend_utc = val - self.wake_hours_weekend_utc * 100
+
+    def _set_water_lvl(self, val):
+        self.water_lvl = val
+
+    def _set_light_status(self, val):
+        self.light_status = val
+        self.check_light_status()
+
     def check_light_status(self):
         """ Greenboxes do some funky stuff with their light.
             If I'm not mistaken, they transmit a status '3' for their light_status in case they
@@ -96,7 +141,7 @@ class GreenBox:
             self.light_on = -1
             return
         if self.light_status == 3:
-            now_utc = datetime.now(timezone.utc)
+            now_utc = self._now_utc()
             start_time = now_utc.replace(hour=self.wake_hours_utc, minute=self.wake_minutes_utc,
                                          second=0, microsecond=0)
             if start_time > now_utc:
@@ -109,13 +154,14 @@ class GreenBox:
         else:
             self.light_on = int(self.light_status == 1)
     def create_7b_message(self, data, control_id):
-        """ Create a formatted 7b message to send to device."""
+        """ Create a formatted 7b message to send to device.
+            The checksum byte is what makes the device listen. Without this magic bit,
+            messages get ignored. Other applications use big boy CRC here, so this took
+            really long to figure out."""
         value_high = data >> 8
-        value_low = data - (value_high << 8)
-        values = [control_id, value_high, value_low]
-        checksum = self.gen_checksum(values)
-        byte_message = bytes([238, control_id, value_high, value_low, checksum, 239])
-        return byte_message
+        value_low = data & 0xFF
+        checksum = (gb_checksum_base - control_id - value_high - value_low) & 0xFF
+        return _pack_7b(238, control_id, value_high, value_low, checksum, 239)
 
     def parse_7b_notification(self, data):
         """ Parse 7 bytes of notification data. There are some rare notifications
@@ -125,16 +171,7 @@ class GreenBox:
         if len(data) < 4:
             return 0, 0
 
-        payload = data[1:4]
-        status_id, value_high, value_low = payload
-        value = (value_high << 8) | value_low
-        return status_id, value
-
-    def gen_checksum(self, values):
-        """ Generates the checksum, in a sarcastic tone.
-            Without this magic bit, messages get ignored.
-            Other applications use big boy CRC here, so this took really long to figure out."""
-        return (gb_checksum_base - sum(values)) % 256
+        return data[1], (data[2] << 8) | data[3]
 
     async def lamp_control(self, strength, lamp_id):
         """ Control one of the 3 lamps. Strength between 0 and 100, lamp_id between 0 and 2"""
@@ -142,6 +179,24 @@ class GreenBox:
         await self.write_to_status(msg)
         return
 
+    async def lamp_control_many(self, levels):
+        """ Set several lamps at once. levels[i] is the strength (0 to 100) for lamp i.
+            All writes are queued back to back, then this waits until they are sent. """
+        if len(levels) > len(gb_lamps):
+            raise ValueError(f"Got {len(levels)} levels, but there are only {len(gb_lamps)} lamps.")
+        msgs = [self.create_7b_message(self.valchk(strength, 100), gb_lamps[lamp_id])
+                for lamp_id, strength in enumerate(levels)]
+        pending = []
+        try:
+            for msg in msgs:
+                pending.append(await self._queue_write(gb_characteristic_uuid, msg))
+        finally:
+            # Settle everything already queued, even if queueing the rest failed
+            results = await asyncio.gather(*pending, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
     async def turn_light_on(self):
         await self.write_to_status(self.create_7b_message(1, gb_light_on))
 
@@ -169,23 +224,30 @@ class GreenBox:
         """ Helper function limits the range of values. """
         return max(min(int(val), max_val), min_val)
 
-    async def process_incoming(self):
-        """ Process data queue entries."""
+    def _on_notification(self, sender, data):
+        """ Notification callback. Updates state right away, logging is queued. """
+        self.proc_known_ids(data)
+        if self._debug:
+            timestamp = time.time_ns()
+            self._log_queue.put_nowait((bytes(data), timestamp))
+
+    async def _log_worker(self):
+        """ Feed logged notifications into the debug data store, off the notification path. """
         try:
             while True:
-                sender, data = await self._notification_queue.get()
-                timestamp = datetime.now().isoformat(sep=' ', timespec='milliseconds')
-                self.proc_known_ids(data)
+                data, timestamp = await self._log_queue.get()
                 self.proc_all(data, timestamp)
         except asyncio.CancelledError:
-            print("Notification processor stopped.")
+            pass
 
     def update(self):
         """ CLI status screen """
-        os.system('cls' if os.name == 'nt' else 'clear')
-        self.show_status()
+        screen = self.show_status()
         if self._debug:
-            self.show_all()
+            screen += self.show_all()
+        # ANSI clear + cursor home instead of spawning 'clear'/'cls' on every refresh
+        sys.stdout.write('\x1b[2J\x1b[H' + screen)
+        sys.stdout.flush()
 
     def show_status(self):
         time_str = (f"Wake time: {self.wake_hours_utc:02d}:{self.wake_minutes_utc:02d} (UTC)"
@@ -194,30 +256,33 @@ class GreenBox:
             time_str += (
                 f" and Wake_time: {self.wake_hours_weekend_utc:02d}:{self.wake_minutes_weekend_utc:02d} (UTC)"
                 f" for {self.hours_on_weekend} hours on weekends")
-        print(time_str)
-        print(f"Light is {'on' if self.light_on else 'off'}.")
-        print("Lamps:")
-        for i, l in enumerate(self.lamp_lvl):
-            print(f'Lamp {i}: {l}')
-        print("Water level:")
-        print(f"{self.water_lvl} / 100")
+        lines = [time_str,
+                 f"Light is {'on' if self.light_on else 'off'}.",
+                 "Lamps:"]
+        lines += [f'Lamp {i}: {l}' for i, l in enumerate(self.lamp_lvl)]
+        lines += ["Water level:", f"{self.water_lvl} / 100"]
+        return '\n'.join(lines) + '\n'
 
     def show_all(self):
-        print('\n')
         sorted_list = self._data_store.items()
-        self.print_status(sorted_list, lambda x: x['val_id'] not in gb_unkown_ids)
-        print('\nUnknown data:')
-        self.print_status(sorted_list, lambda x: x['val_id'] in gb_unkown_ids)
+        return ('\n\n' + self.format_status(sorted_list, lambda x: x['val_id'] not in gb_unkown_ids)
+                + '\nUnknown data:\n' + self.format_status(sorted_list, lambda x: x['val_id'] in gb_unkown_ids))
 
-    def print_status(self, status_list, condition):
+    def format_status(self, status_list, condition):
         header = f"{'Fields':<12} | {'Added ':<23} | {'Updated ':<24}| {'Raw value':<25} | {'Command':<14}"
-        print(header)
-        print("-" * len(header))
+        lines = [header, "-" * len(header)]
         for field, info in status_list:
             if condition(info):
                 raw_info =[f"{int(i):3d}" for i in info['raw_val']]
                 parsed_info = [f"{int(i):3d}" for i in info['parsed']]
-                print(f"{field} | {info['first_timestamp']} | {info['timestamp']} | [{' '.join(raw_info)}] | {' -> '.join(parsed_info)}")
+                added, updated = self.format_ns(info['first_timestamp']), self.format_ns(info['timestamp'])
+                lines.append(f"{field.hex()} | {added} | {updated} | [{' '.join(raw_info)}] | {' -> '.join(parsed_info)}")
+        return '\n'.join(lines) + '\n'
+
+    def format_ns(self, timestamp_ns):
+        """ Format a time.time_ns() timestamp as local time for display. """
+        return datetime.fromtimestamp(timestamp_ns / 1e9).isoformat(sep=' ', timespec='milliseconds')
+
     async def scan_uuids(self):
         """ Utility which scans open UUIDs. Unused, but nice to have. """
         for service in self._client.services:
@@ -228,9 +293,12 @@ class GreenBox:
     async def __aenter__(self):
         try:
             await self._client.connect()
-            await self._client.start_notify(gb_characteristic_uuid,
-                                           lambda s, d: self._notification_queue.put_nowait((s, d)))
-            self._queue_worker = asyncio.create_task(self.process_incoming())
+            char = self._client.services.get_characteristic(gb_characteristic_uuid)
+            # Only skip the response if the device actually offers write-without-response
+            self._write_response = char is None or 'write-without-response' not in char.properties
+            await self._client.start_notify(gb_characteristic_uuid, self._on_notification)
+            self._log_task = asyncio.create_task(self._log_worker())
+            self._tx_task = asyncio.create_task(self._tx_loop())
             print("Connected, waiting for data...")
             await asyncio.sleep(2)
             print("Now listening to device..")
@@ -241,14 +309,74 @@ class GreenBox:
 
     async def __aexit__(self, exc_type, exc, tb):
         print("Shutting down...")
+        self._log_task.cancel()
+        if exc_type is None:
+            try:
+                await asyncio.wait_for(self._tx_queue.join(), _tx_flush_timeout)
+            except TimeoutError:
+                logger.warning("Queued writes not sent after %s seconds, dropping them.", _tx_flush_timeout)
+        tx_task, self._tx_task = self._tx_task, None
+        tx_task.cancel()
+        await asyncio.wait([tx_task])
+        self._drop_pending_writes()
         await self._client.stop_notify(gb_characteristic_uuid)
         await self._client.disconnect()
 
     async def write_to_status(self, data):
-        await self.safe_write_no_response(gb_characteristic_uuid, data)
+        await self.safe_write(gb_characteristic_uuid, data)
+
+    async def safe_write(self, char_uuid, data):
+        """ Send a write through the TX worker and wait until it went out.
+            Uses write-without-response where the characteristic supports it and falls
+            back to acknowledged writes otherwise. Raises whatever the write raised. """
+        done = await self._queue_write(char_uuid, data)
+        await done
+
+    async def _queue_write(self, char_uuid, data):
+        """ Queue a write for the TX worker and return a future for its outcome.
+            Waits if too many writes are pending. """
+        if self._tx_task is None or self._tx_task.done():
+            raise RuntimeError("Not connected. Use GreenBox as 'async with GreenBox(...)'.")
+        done = asyncio.get_running_loop().create_future()
+        await self._tx_queue.put((char_uuid, data, done))
+        if self._tx_task is None:
+            # Shut down while we were waiting for a free slot
+            done.set_exception(RuntimeError("Disconnected before the write was sent."))
+        return done
+
+    def _drop_pending_writes(self):
+        """ Fail every write still waiting in the queue. """
+        while not self._tx_queue.empty():
+            _, _, done = self._tx_queue.get_nowait()
+            if not done.done():
+                done.set_exception(RuntimeError("Disconnected before the write was sent."))
+            self._tx_queue.task_done()
+
+    async def _tx_loop(self):
+        """ Single writer, so writes never pile up in the BLE stack.
+            The outcome of each write is reported through its future. """
+        while True:
+            char_uuid, data, done = await self._tx_queue.get()
+            try:
+                if not done.done():
+                    await self._write_chunked(char_uuid, data)
+                    if not done.done():
+                        done.set_result(None)
+            except asyncio.CancelledError:
+                if not done.done():
+                    done.set_exception(RuntimeError("Disconnected before the write was sent."))
+                raise
+            except Exception as Err:
+                if not done.done():
+                    done.set_exception(Err)
+            finally:
+                self._tx_queue.task_done()
 
-    async def safe_write_no_response(self, char_uuid, data):
-        async with self._bt_write_lock:
-            await self._client.write_gatt_char(char_uuid, data, response=False)
+    async def _write_chunked(self, char_uuid, data):
+        """ Split data into frames that fit the default ATT payload. """
+        for i in range(0, len(data), gb_max_chunk):
+            await self._client.write_gatt_char(char_uuid, data[i:i + gb_max_chunk],
+                                               response=self._write_response)
+            await asyncio.sleep(0)
 
 